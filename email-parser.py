@@ -1,13 +1,32 @@
 from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+from google.auth.exceptions import RefreshError
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from supabase import create_client
 import os
 from dotenv import load_dotenv
 import base64
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import re
+import itertools
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import random
+import hashlib
+import sqlite3
+import json
+import zlib
+from email.utils import parsedate_to_datetime, parseaddr
+from datetime import datetime, timezone, date
+from html.parser import HTMLParser
+import email
+from email.header import decode_header, make_header
 
 # Load environment variables
 load_dotenv()
@@ -21,32 +40,303 @@ print('Environment loaded successfully')
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 ALLOWED_DOMAINS = os.getenv('ALLOWED_DOMAINS', '').split(',')
 GPTZERO_API_URL = "https://api.gptzero.me/v2/predict/text"
+GMAIL_TOKEN_FILE = os.getenv('GMAIL_TOKEN_FILE', 'token.json')
+GPTZERO_CONNECT_TIMEOUT = float(os.getenv('GPTZERO_CONNECT_TIMEOUT', '5'))
+GPTZERO_READ_TIMEOUT = float(os.getenv('GPTZERO_READ_TIMEOUT', '60'))
+GPTZERO_POOL_SIZE = int(os.getenv('GPTZERO_POOL_SIZE', '10'))
+GMAIL_QUOTA_UNITS_PER_SECOND = float(os.getenv('GMAIL_QUOTA_UNITS_PER_SECOND', '250'))
+GMAIL_FIELD_MASK = os.getenv('GMAIL_FIELD_MASK', '1') != '0'
+GMAIL_PREFILTER = os.getenv('GMAIL_PREFILTER', '0') != '0'
+PREFILTER_MAX_BYTES = int(os.getenv('PREFILTER_MAX_BYTES', '5000000'))
+AUTOMATED_SENDERS = [
+    s.strip().lower() for s in os.getenv(
+        'AUTOMATED_SENDERS', 'noreply,no-reply,donotreply,do-not-reply,mailer-daemon,postmaster,bounce'
+    ).split(',') if s.strip()
+]
+GMAIL_PAGE_SIZE = int(os.getenv('GMAIL_PAGE_SIZE', '500'))
+GMAIL_FETCH_MODE = os.getenv('GMAIL_FETCH_MODE', 'batch')
+GMAIL_BATCH_SIZE = min(int(os.getenv('GMAIL_BATCH_SIZE', '100')), 100)
+SYNC_MODE = os.getenv('SYNC_MODE', 'full')
+HISTORY_CHECKPOINT_FILE = os.getenv('HISTORY_CHECKPOINT_FILE', '.gmail_history_id')
+OFFLINE_SOURCE = os.getenv('OFFLINE_SOURCE', '')
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'sequential')
+SCORING_CONCURRENCY = int(os.getenv('SCORING_CONCURRENCY', '4'))
+GPTZERO_RATE_LIMIT = float(os.getenv('GPTZERO_RATE_LIMIT', '0.5'))
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '5'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '2'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '120'))
+SCORE_CACHE_PATH = os.getenv('SCORE_CACHE_PATH', '.score_cache.sqlite3')
+SCORE_CACHE_MAX_ENTRIES = int(os.getenv('SCORE_CACHE_MAX_ENTRIES', '100000'))
+PAYLOAD_CACHE_PATH = os.getenv('PAYLOAD_CACHE_PATH', '.payload_cache.sqlite3')
+# 0 disables the payload cache
+PAYLOAD_CACHE_MAX_BYTES = int(os.getenv('PAYLOAD_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+USAGE_LEDGER_PATH = os.getenv('USAGE_LEDGER_PATH', '.usage_ledger.sqlite3')
+USAGE_BILLING_DAY = int(os.getenv('USAGE_BILLING_DAY', '1'))
+BUDGET_OBJECTIVE = os.getenv('BUDGET_OBJECTIVE', '')
+PRIORITY_SENDERS = [s.strip().lower() for s in os.getenv('PRIORITY_SENDERS', '').split(',') if s.strip()]
+REDUCE_BODIES = os.getenv('REDUCE_BODIES', '1') != '0'
+NEAR_DUP_INDEX_PATH = os.getenv('NEAR_DUP_INDEX_PATH', '.near_dup_index.sqlite3')
+NEAR_DUP_MAX_DISTANCE = int(os.getenv('NEAR_DUP_MAX_DISTANCE', '3'))
+NEAR_DUP_MIN_WORDS = int(os.getenv('NEAR_DUP_MIN_WORDS', '50'))
+WORD_COUNT_STRATEGY = os.getenv('WORD_COUNT_STRATEGY', 'regex')
+UPSERT_BATCH_SIZE = int(os.getenv('UPSERT_BATCH_SIZE', '50'))
+UPSERT_FLUSH_SECONDS = float(os.getenv('UPSERT_FLUSH_SECONDS', '30'))
+
+# Maximal \w+ runs are exactly the \b\w+\b matches, so counts are unchanged
+WORD_RE = re.compile(r'\w+')
 
 def count_words(text):
     """Count words in text, handling various whitespace cases"""
-    return len(re.findall(r'\b\w+\b', text))
+    return sum(1 for _ in WORD_RE.finditer(text))
+
+# Scripts written without spaces between words (CJK ideographs, kana, Thai)
+DENSE_SCRIPT_RE = re.compile('[\u0e00-\u0e7f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+
+def count_words_whitespace(text):
+    """Count whitespace-separated tokens, so URLs, numbers and contractions are one word each"""
+    return len(text.split())
+
+def count_words_gptzero(text):
+    """Approximate GPTZero billing: whitespace tokens containing a letter or digit,
+    with each character of a no-space script counted as its own word"""
+    if not DENSE_SCRIPT_RE.search(text):
+        return sum(1 for token in text.split() if WORD_RE.search(token))
+    words = 0
+    for token in text.split():
+        dense = len(DENSE_SCRIPT_RE.findall(token))
+        if dense:
+            words += dense + (1 if WORD_RE.search(DENSE_SCRIPT_RE.sub('', token)) else 0)
+        elif WORD_RE.search(token):
+            words += 1
+    return words
+
+WORD_COUNTERS = {
+    'regex': count_words,
+    'whitespace': count_words_whitespace,
+    'gptzero': count_words_gptzero,
+}
+
+class WordLimitExceeded(Exception):
+    """The usage ledger refused a charge that would go over the word limit"""
+
+def billing_period_start(today=None, billing_day=USAGE_BILLING_DAY):
+    """First day of the billing period containing today"""
+    today = today or datetime.now(timezone.utc).date()
+    if today.day >= billing_day:
+        return today.replace(day=billing_day)
+    if today.month == 1:
+        return date(today.year - 1, 12, billing_day)
+    return date(today.year, today.month - 1, billing_day)
+
+class UsageLedger:
+    """Durable log of GPTZero word usage per billing period.
+
+    Every call is a row that starts out 'reserved' and is either committed
+    or deleted, and the period total is the sum of all rows. Reservations are
+    checked against the limit inside an IMMEDIATE transaction, so concurrent
+    workers sharing the file cannot overshoot it. Reservations left behind by
+    a crashed worker expire after reservation_ttl seconds.
+    """
+    def __init__(self, path=USAGE_LEDGER_PATH, billing_day=USAGE_BILLING_DAY, reservation_ttl=3600):
+        # Clamp so every month has the billing day
+        self.billing_day = min(max(billing_day, 1), 28)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS usage ('
+            'id INTEGER PRIMARY KEY, period TEXT NOT NULL, words INTEGER NOT NULL, created_at REAL NOT NULL, '
+            "status TEXT NOT NULL DEFAULT 'committed')"
+        )
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(usage)')]
+        if 'status' not in columns:
+            self.conn.execute("ALTER TABLE usage ADD COLUMN status TEXT NOT NULL DEFAULT 'committed'")
+        self.conn.execute('CREATE INDEX IF NOT EXISTS usage_period ON usage (period)')
+        self.conn.execute(
+            "DELETE FROM usage WHERE status = 'reserved' AND created_at < ?", (time.time() - reservation_ttl,)
+        )
+
+    def current_period(self):
+        return billing_period_start(billing_day=self.billing_day).isoformat()
+
+    def used(self, period=None):
+        """Committed plus outstanding reserved words in the period"""
+        period = period or self.current_period()
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COALESCE(SUM(words), 0) FROM usage WHERE period = ?', (period,)
+            ).fetchone()[0]
+
+    def reserve(self, words, limit=None):
+        """Atomically set aside words in the current period.
+
+        Returns (entry_id, period_total); entry_id is None and nothing is
+        recorded when the reservation would take the period over limit.
+        """
+        period = self.current_period()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                used = self.conn.execute(
+                    'SELECT COALESCE(SUM(words), 0) FROM usage WHERE period = ?', (period,)
+                ).fetchone()[0]
+                if limit is not None and used + words > limit:
+                    self.conn.execute('ROLLBACK')
+                    return None, used
+                entry_id = self.conn.execute(
+                    "INSERT INTO usage (period, words, created_at, status) VALUES (?, ?, ?, 'reserved')",
+                    (period, words, time.time())
+                ).lastrowid
+                self.conn.execute('COMMIT')
+                return entry_id, used + words
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def commit(self, entry_id):
+        with self.lock:
+            self.conn.execute("UPDATE usage SET status = 'committed' WHERE id = ?", (entry_id,))
+
+    def release(self, entry_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM usage WHERE id = ? AND status = 'reserved'", (entry_id,))
+
+    def close(self):
+        self.conn.close()
 
 class UsageTracker:
-    def __init__(self, limit=300000):
-        self.word_count = 0
+    """Word usage against the GPTZero limit.
+
+    Callers reserve() words before a request and then commit() or release()
+    the reservation. Reserved words count against the limit straight away,
+    so parallel workers can never collectively go over it.
+    """
+    def __init__(self, limit=300000, ledger=None, strategy=WORD_COUNT_STRATEGY):
+        if strategy not in WORD_COUNTERS:
+            raise ValueError(f"Unknown WORD_COUNT_STRATEGY: {strategy}")
+        self.strategy = strategy
+        self.count_words = WORD_COUNTERS[strategy]
+        self.ledger = ledger
+        self.lock = threading.Lock()
+        self.word_count = ledger.used() if ledger else 0
         self.word_limit = limit
+        self.run_words = 0
         self.emails_processed = 0
+        self.reconciled_calls = 0
+        self.reconciled_counted = 0
+        self.reconciled_billed = 0
+
+    def reserve(self, words):
+        """Set aside words for one request; returns a reservation or raises WordLimitExceeded"""
+        with self.lock:
+            if self.ledger:
+                entry_id, self.word_count = self.ledger.reserve(words, self.word_limit)
+                accepted = entry_id is not None
+            else:
+                entry_id = None
+                accepted = self.word_count + words <= self.word_limit
+                if accepted:
+                    self.word_count += words
+            if not accepted:
+                raise WordLimitExceeded(f"{words:,} words would exceed the limit ({self.word_count:,} used)")
+            return entry_id, words
+
+    def commit(self, reservation):
+        """Count a reservation as spent once the request went through"""
+        entry_id, words = reservation
+        with self.lock:
+            if self.ledger:
+                self.ledger.commit(entry_id)
+            self.run_words += words
+            self.emails_processed += 1
+
+    def release(self, reservation):
+        """Return a reservation's words after a failed or rate-limited request"""
+        entry_id, words = reservation
+        with self.lock:
+            if self.ledger:
+                self.ledger.release(entry_id)
+            self.word_count -= words
         
-    def add_usage(self, text):
-        words = count_words(text)
-        self.word_count += words
-        self.emails_processed += 1
-        return words
-    
+    def reconcile(self, counted, billed):
+        """Record our count for a call next to the word usage GPTZero reported for it"""
+        with self.lock:
+            self.reconciled_calls += 1
+            self.reconciled_counted += counted
+            self.reconciled_billed += billed
+
+    def get_reconciliation(self):
+        """Compare our tally with vendor-reported usage over the calls that reported it"""
+        drift = self.reconciled_counted - self.reconciled_billed
+        return {
+            'strategy': self.strategy,
+            'calls': self.reconciled_calls,
+            'counted_words': self.reconciled_counted,
+            'billed_words': self.reconciled_billed,
+            'drift_words': drift,
+            'drift_percentage': (drift / self.reconciled_billed) * 100 if self.reconciled_billed else 0
+        }
+
     def get_stats(self):
         return {
             'total_words': self.word_count,
+            'run_words': self.run_words,
             'percentage_used': (self.word_count / self.word_limit) * 100,
             'words_remaining': self.word_limit - self.word_count,
             'emails_processed': self.emails_processed,
-            'average_words_per_email': self.word_count / self.emails_processed if self.emails_processed > 0 else 0
+            'average_words_per_email': self.run_words / self.emails_processed if self.emails_processed > 0 else 0
         }
 
+# Gmail API quota units charged per call
+GMAIL_QUOTA_COSTS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'history.list': 2,
+    'getProfile': 1,
+}
+
+class TokenBucket:
+    """Token bucket refilled at `rate` units per second, holding at most `capacity`; thread-safe"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, cost):
+        """Block until cost units are available, then take them"""
+        if cost > self.capacity:
+            raise ValueError(f"Cost of {cost} units can never fit a bucket holding {self.capacity}")
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                delay = (cost - self.tokens) / self.rate
+                self.waited += delay
+            time.sleep(delay)
+
+    def fill_level(self):
+        """Fraction of the bucket currently available, 0.0 to 1.0"""
+        with self.lock:
+            self._refill()
+            return self.tokens / self.capacity
+
+gmail_bucket = TokenBucket(GMAIL_QUOTA_UNITS_PER_SECOND)
+
+def gmail_execute(request, method):
+    """Execute a Gmail API request once the quota bucket can pay for it"""
+    gmail_bucket.acquire(GMAIL_QUOTA_COSTS[method])
+    return request.execute()
+
 def get_gmail_service():
     client_config = {
         'web': {
@@ -58,66 +348,685 @@ def get_gmail_service():
         }
     }
     
-    flow = InstalledAppFlow.from_client_config(client_config, SCOPES)
-    creds = flow.run_local_server(port=8080)
+    creds = load_credentials()
+    if not creds:
+        flow = InstalledAppFlow.from_client_config(client_config, SCOPES)
+        creds = flow.run_local_server(port=8080)
+        save_credentials(creds)
     return build('gmail', 'v1', credentials=creds)
 
-def check_email_exists(supabase, message_id):
-    """Check if email exists and has GPTZero scores"""
+def load_credentials(path=GMAIL_TOKEN_FILE):
+    """Reuse cached OAuth credentials, refreshing them if expired; None if unusable"""
+    if not os.path.exists(path):
+        return None
+    try:
+        creds = Credentials.from_authorized_user_file(path, SCOPES)
+    except ValueError as e:
+        print(f"Ignoring unreadable token file: {str(e)}")
+        return None
+    if creds.valid:
+        return creds
+    if creds.expired and creds.refresh_token:
+        try:
+            creds.refresh(Request())
+        except RefreshError as e:
+            print(f"Token refresh failed, falling back to browser consent: {str(e)}")
+            return None
+        save_credentials(creds, path)
+        return creds
+    return None
+
+def save_credentials(creds, path=GMAIL_TOKEN_FILE):
+    # The file holds a refresh token, so keep it private to the user
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(creds.to_json())
+
+def list_message_ids(gmail, query, page_size=GMAIL_PAGE_SIZE):
+    """Lazily yield message IDs matching query, following nextPageToken"""
+    page_token = None
+    while True:
+        results = gmail_execute(gmail.users().messages().list(
+            userId='me', q=query, maxResults=page_size, pageToken=page_token
+        ), 'messages.list')
+        for message_meta in results.get('messages', []):
+            yield message_meta['id']
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+def load_history_checkpoint(path=HISTORY_CHECKPOINT_FILE):
+    """Return the historyId saved by the last completed run, or None"""
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def save_history_checkpoint(history_id, path=HISTORY_CHECKPOINT_FILE):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(str(history_id))
+    os.replace(tmp_path, path)
+
+def get_current_history_id(gmail):
+    return gmail_execute(gmail.users().getProfile(userId='me'), 'getProfile')['historyId']
+
+# Search leaves these out by default, so incremental sync must too
+HISTORY_SKIP_LABELS = {'DRAFT', 'SPAM', 'TRASH'}
+
+def list_added_message_ids(gmail, start_history_id, page_size=GMAIL_PAGE_SIZE):
+    """Lazily yield IDs of messages added since start_history_id"""
+    page_token = None
+    seen = set()
+    while True:
+        results = gmail_execute(gmail.users().history().list(
+            userId='me',
+            startHistoryId=start_history_id,
+            historyTypes=['messageAdded'],
+            maxResults=page_size,
+            pageToken=page_token
+        ), 'history.list')
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message = added['message']
+                if message['id'] in seen or HISTORY_SKIP_LABELS & set(message.get('labelIds', [])):
+                    continue
+                seen.add(message['id'])
+                yield message['id']
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+def get_sender(message):
+    headers = message['payload']['headers']
+    return next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
+
+def sender_allowed(sender):
+    """Check a From header's address against ALLOWED_DOMAINS, which may also list full addresses"""
+    address = parseaddr(sender)[1].lower()
+    if '@' not in address:
+        return False
+    domain = address.rsplit('@', 1)[1]
+    for allowed in ALLOWED_DOMAINS:
+        allowed = allowed.strip().lower()
+        if not allowed:
+            continue
+        if '@' in allowed:
+            if address == allowed:
+                return True
+        elif domain == allowed or domain.endswith('.' + allowed):
+            return True
+    return False
+
+TAKEOUT_FROM_RE = re.compile(rb'^From (\d+)@xxx ')
+
+def iter_mbox(path):
+    """Stream (from_line, raw_bytes) out of an mbox file one message at a time"""
+    from_line = None
+    lines = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'From '):
+                if from_line is not None:
+                    yield from_line, b''.join(lines)
+                from_line = line
+                lines = []
+            elif from_line is not None:
+                # Undo mboxrd/mboxo ">From " escaping
+                if line.startswith(b'>') and line.lstrip(b'>').startswith(b'From '):
+                    line = line[1:]
+                lines.append(line)
+    if from_line is not None:
+        yield from_line, b''.join(lines)
+
+def is_maildir(path):
+    return os.path.isdir(os.path.join(path, 'cur')) and os.path.isdir(os.path.join(path, 'new'))
+
+def iter_message_files(path):
+    """Yield (None, raw_bytes) for a .eml file, a directory tree of .eml files, or a Maildir
+    including its Maildir++ subfolders. Directories are streamed in filesystem order."""
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            yield None, f.read()
+        return
+    # (directory, whether it's a Maildir cur/new, where every file is a message)
+    stack = [(path, False)]
+    while stack:
+        directory, maildir_files = stack.pop()
+        if not maildir_files and is_maildir(directory):
+            stack.append((os.path.join(directory, 'cur'), True))
+            stack.append((os.path.join(directory, 'new'), True))
+            # Maildir++ keeps subfolders next to cur/new as .Folder maildirs
+            with os.scandir(directory) as entries:
+                stack.extend(
+                    (entry.path, False) for entry in entries
+                    if entry.name.startswith('.') and entry.is_dir() and is_maildir(entry.path)
+                )
+            continue
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not maildir_files:
+                        stack.append((entry.path, False))
+                elif entry.is_file() and (maildir_files or entry.name.lower().endswith('.eml')):
+                    with open(entry.path, 'rb') as f:
+                        yield None, f.read()
+
+def decode_header_value(value):
     try:
-        response = supabase.table('emails').select('*').eq('message_id', message_id).execute()
-        if response.data:
-            email = response.data[0]
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return str(value)
+
+def offline_message_id(from_line, raw, parsed):
+    """Stable ID for an archived message.
+
+    Google Takeout mbox From_ lines carry the Gmail message ID in decimal, so
+    those map to the same hex ID the Gmail API uses and dedupe against it.
+    Otherwise the Message-ID header, or failing that the raw bytes, is hashed.
+    """
+    if from_line:
+        match = TAKEOUT_FROM_RE.match(from_line)
+        if match:
+            return format(int(match.group(1)), 'x')
+    message_id_header = parsed.get('Message-ID')
+    if message_id_header:
+        return 'mid-' + hashlib.sha256(str(message_id_header).strip().encode('utf-8')).hexdigest()[:24]
+    return 'raw-' + hashlib.sha256(raw).hexdigest()[:24]
+
+def to_gmail_message(message_id, parsed):
+    """Shape a parsed email.message.Message like a Gmail API 'full' message"""
+    def shape(part):
+        return {
+            'mimeType': part.get_content_type(),
+            'filename': part.get_filename() or '',
+            'headers': [{'name': name, 'value': decode_header_value(value)} for name, value in part.items()],
+            'body': {}
+        }
+
+    payload = shape(parsed)
+    stack = [(parsed, payload)]
+    while stack:
+        part, shaped = stack.pop()
+        if part.is_multipart():
+            shaped['parts'] = []
+            for child in part.get_payload():
+                shaped_child = shape(child)
+                shaped['parts'].append(shaped_child)
+                stack.append((child, shaped_child))
+        elif part.get_content_maintype() == 'text' and not shaped['filename']:
+            # Only text parts are decoded; attachment data is never touched
+            data = part.get_payload(decode=True) or b''
+            shaped['body'] = {'data': base64.urlsafe_b64encode(data).decode('ascii'), 'size': len(data)}
+
+    message = {'id': message_id, 'payload': payload}
+    date_header = parsed.get('Date')
+    if date_header:
+        try:
+            message['internalDate'] = str(int(parsedate_to_datetime(str(date_header)).timestamp() * 1000))
+        except (TypeError, ValueError):
+            pass
+    return message
+
+def iter_offline_messages(path):
+    """Stream (message_id, message) pairs from an mbox, Maildir, .eml file or .eml directory,
+    keeping only senders in ALLOWED_DOMAINS"""
+    raw_messages = iter_message_files(path) if os.path.isdir(path) or path.lower().endswith('.eml') else iter_mbox(path)
+    for from_line, raw in raw_messages:
+        try:
+            parsed = email.message_from_bytes(raw)
+            if not sender_allowed(decode_header_value(parsed.get('From', ''))):
+                continue
+            message_id = offline_message_id(from_line, raw, parsed)
+            yield message_id, to_gmail_message(message_id, parsed)
+        except Exception as e:
+            print(f"Error reading archived message: {str(e)}")
+
+def chunked(iterable, size):
+    """Yield lists of up to size items from iterable"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def gmail_part_fields(depth):
+    """Partial-response mask for a MIME part and `depth` levels of nested parts"""
+    fields = 'mimeType,filename,headers,body(data,attachmentId)'
+    return f"{fields},parts({gmail_part_fields(depth - 1)})" if depth else f"{fields},parts"
+
+# Only what get_email_body and the pipeline read; drops snippet, labelIds,
+# threadId, historyId and part IDs/sizes from every response
+GMAIL_FULL_FIELDS = f"id,internalDate,sizeEstimate,payload({gmail_part_fields(4)})"
+GMAIL_METADATA_FIELDS = 'id,internalDate,sizeEstimate,payload/headers'
+
+def message_get_request(gmail, message_id, fmt='full'):
+    """Build a messages.get request; 'metadata' returns just the From header and size"""
+    if fmt == 'metadata':
+        return gmail.users().messages().get(
+            userId='me', id=message_id, format='metadata', metadataHeaders=['From'],
+            fields=GMAIL_METADATA_FIELDS if GMAIL_FIELD_MASK else None
+        )
+    return gmail.users().messages().get(
+        userId='me', id=message_id, format='full',
+        fields=GMAIL_FULL_FIELDS if GMAIL_FIELD_MASK else None
+    )
+
+def fetch_message(gmail, message_id, fmt='full'):
+    return gmail_execute(message_get_request(gmail, message_id, fmt), 'messages.get')
+
+def is_retryable_gmail_error(error):
+    """Transport failures, 429s, 5xx and 403 rate-limit errors are worth retrying"""
+    if not isinstance(error, HttpError):
+        return True
+    status = error.resp.status
+    if status == 403:
+        return b'ratelimitexceeded' in (error.content or b'').lower()
+    return status == 429 or status >= 500
+
+def fetch_messages_batch(gmail, message_ids, fmt='full', max_attempts=RETRY_MAX_ATTEMPTS):
+    """Fetch up to 100 messages in HTTP batches sized to the Gmail quota bucket.
+
+    Items that fail with a retryable error, or every unanswered item when the
+    batch call itself fails, are re-batched with backoff; whatever still fails
+    after max_attempts is fetched one at a time. Other failures are reported
+    and omitted.
+    """
+    messages = {}
+    pending = list(message_ids)
+    cost = GMAIL_QUOTA_COSTS['messages.get']
+    # Every request inside a batch is charged separately and they all reach
+    # Gmail at once, so a batch can't cost more than the bucket holds
+    batch_size = max(1, int(gmail_bucket.capacity // cost))
+    for attempt in range(max_attempts):
+        answered = set()
+        retry = []
+
+        def on_response(request_id, response, exception):
+            answered.add(request_id)
+            if exception is None:
+                messages[request_id] = response
+            elif is_retryable_gmail_error(exception):
+                retry.append(request_id)
+            else:
+                print(f"Error fetching message {request_id}: {str(exception)}")
+
+        for chunk in chunked(pending, batch_size):
+            batch = gmail.new_batch_http_request(callback=on_response)
+            for message_id in chunk:
+                batch.add(message_get_request(gmail, message_id, fmt), request_id=message_id)
+            gmail_bucket.acquire(cost * len(chunk))
+            try:
+                batch.execute()
+            except Exception as e:
+                print(f"Gmail batch request failed: {str(e)}")
+                retry.extend(message_id for message_id in chunk if message_id not in answered)
+        if not retry:
+            return messages
+        pending = retry
+        if attempt + 1 < max_attempts:
+            time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+
+    print(f"Fetching {len(pending)} messages individually after {max_attempts} batch attempts")
+    for message_id in pending:
+        try:
+            messages[message_id] = fetch_message(gmail, message_id, fmt)
+        except Exception as e:
+            print(f"Error fetching message {message_id}: {str(e)}")
+    return messages
+
+def fetch_messages(gmail, message_ids, fmt='full', payload_cache=None):
+    """Fetch messages by ID using the configured GMAIL_FETCH_MODE.
+
+    Full payloads found in payload_cache are served from disk, and newly
+    fetched ones are added to it; message content never changes for an ID.
+    """
+    if not message_ids:
+        return {}
+    if payload_cache is None or fmt != 'full':
+        return fetch_messages_uncached(gmail, message_ids, fmt)
+    messages = payload_cache.get_many(message_ids)
+    missing = [message_id for message_id in message_ids if message_id not in messages]
+    if missing:
+        fetched = fetch_messages_uncached(gmail, missing, fmt)
+        payload_cache.put_many(fetched)
+        messages.update(fetched)
+    return messages
+
+def fetch_messages_uncached(gmail, message_ids, fmt='full'):
+    if GMAIL_FETCH_MODE == 'batch':
+        return fetch_messages_batch(gmail, message_ids, fmt)
+    messages = {}
+    for message_id in message_ids:
+        try:
+            messages[message_id] = fetch_message(gmail, message_id, fmt)
+        except Exception as e:
+            print(f"Error fetching message {message_id}: {str(e)}")
+    return messages
+
+def check_emails_exist(supabase, message_ids):
+    """Check which emails exist and have GPTZero scores, one query per page of IDs.
+
+    Returns a dict of message_id -> (exists, has_scores); IDs missing from
+    the table map to (False, False).
+    """
+    status = {message_id: (False, False) for message_id in message_ids}
+    if not message_ids:
+        return status
+    try:
+        response = supabase.table('emails').select(
+            'message_id, gpt_zero_ai, gpt_zero_human'
+        ).in_('message_id', list(message_ids)).execute()
+        for email in response.data:
             has_scores = email.get('gpt_zero_ai') is not None and email.get('gpt_zero_human') is not None
-            return True, has_scores
-        return False, False
+            status[email['message_id']] = (True, has_scores)
     except Exception as e:
         print(f"Error checking email existence: {str(e)}")
-        return False, False
+    return status
+
+class RateLimited(Exception):
+    """GPTZero answered 429; retry_after is the server's requested wait in seconds, if any"""
+    def __init__(self, retry_after=None):
+        super().__init__(f"Rate limited (retry after {retry_after}s)" if retry_after is not None else "Rate limited")
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    """Parse a Retry-After header given as delta-seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+# Places a GPTZero response may report the words it billed, checked in order
+GPTZERO_USAGE_FIELDS = [
+    ('usage', 'words'),
+    ('usage', 'word_count'),
+    ('documents', 0, 'word_count'),
+    ('documents', 0, 'num_words'),
+]
 
-def get_gptzero_scores(text, usage_tracker):
-    """Get GPTZero scores and track word usage"""
-    words = usage_tracker.add_usage(text)
+def get_billed_words(result):
+    """Word usage reported by a GPTZero response, or None"""
+    for path in GPTZERO_USAGE_FIELDS:
+        value = result
+        try:
+            for key in path:
+                value = value[key]
+        except (KeyError, IndexError, TypeError):
+            continue
+        if isinstance(value, (int, float)):
+            return int(value)
+    return None
+
+class GPTZeroClient:
+    """GPTZero API client over a pooled keep-alive session"""
+    def __init__(self, api_url=GPTZERO_API_URL, pool_size=GPTZERO_POOL_SIZE,
+                 connect_timeout=GPTZERO_CONNECT_TIMEOUT, read_timeout=GPTZERO_READ_TIMEOUT):
+        self.api_url = api_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+
+    def score(self, text):
+        """Return (ai, human, billed_words), or (None, None, None) on failure.
+
+        billed_words is the usage the response reported, or None if it had
+        none. Raises RateLimited on 429 so the caller can defer the email.
+        """
+        data = {
+            "document": text,
+            "multilingual": False
+        }
+
+        try:
+            response = self.session.post(self.api_url, json=data, timeout=self.timeout)
+            if response.status_code == 200:
+                result = response.json()
+                scores = result['documents'][0]['class_probabilities']
+                return scores.get('ai', 0), scores.get('human', 0), get_billed_words(result)
+            elif response.status_code == 429:
+                print("Rate limit reached for GPTZero API")
+                raise RateLimited(parse_retry_after(response.headers.get('Retry-After')))
+            else:
+                print(f"GPTZero API error: {response.status_code}")
+                return None, None, None
+        except RateLimited:
+            raise
+        except Exception as e:
+            print(f"Error calling GPTZero API: {str(e)}")
+            return None, None, None
+
+    def close(self):
+        self.session.close()
+
+def get_gptzero_scores(text, usage_tracker, client, reservation):
+    """Get GPTZero scores for text whose words are already reserved.
+
+    The reservation is committed when scores come back and released when the
+    call fails or is rate limited.
+    """
+    _, words = reservation
     print(f"Words in this email: {words}")
     stats = usage_tracker.get_stats()
-    print(f"Total words processed: {stats['total_words']:,}")
+    print(f"Words used this billing period: {stats['total_words']:,}")
     print(f"Percentage of limit used: {stats['percentage_used']:.1f}%")
-    
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    
-    data = {
-        "document": text,
-        "multilingual": False
-    }
-    
+
     try:
-        response = requests.post(GPTZERO_API_URL, headers=headers, json=data)
-        if response.status_code == 200:
-            result = response.json()
-            scores = result['documents'][0]['class_probabilities']
-            return scores.get('ai', 0), scores.get('human', 0)
-        elif response.status_code == 429:
-            print("Rate limit reached for GPTZero API")
-            return None, None
-        else:
-            print(f"GPTZero API error: {response.status_code}")
-            return None, None
-    except Exception as e:
-        print(f"Error calling GPTZero API: {str(e)}")
+        ai_score, human_score, billed_words = client.score(text)
+    except Exception:
+        usage_tracker.release(reservation)
+        raise
+    if ai_score is None or human_score is None:
+        usage_tracker.release(reservation)
         return None, None
+    usage_tracker.commit(reservation)
+    if billed_words is not None:
+        usage_tracker.reconcile(words, billed_words)
+    return ai_score, human_score
+
+def is_attachment(part):
+    return bool(part.get('filename')) or 'attachmentId' in part.get('body', {})
+
+def find_text_parts(payload, mime_type='text/plain'):
+    """Walk the MIME tree without recursion and return leaf parts of mime_type in document order.
+
+    Inside multipart/alternative only the mime_type branch is followed, so the
+    HTML twin of a plain-text body is never visited. Attachments are skipped
+    without touching their data.
+    """
+    found = []
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get('parts')
+        if children:
+            if part.get('mimeType') == 'multipart/alternative':
+                preferred = [c for c in children if c.get('mimeType') == mime_type]
+                children = preferred or children
+            stack.extend(reversed(children))
+        elif part.get('mimeType') == mime_type and not is_attachment(part) and part.get('body', {}).get('data'):
+            found.append(part)
+    return found
+
+class HTMLTextExtractor(HTMLParser):
+    """Single-pass HTML to text: drops script/style, keeps block breaks, collapses whitespace"""
+    # Not 'head': its end tag is optional, and skipping to a </head> that never
+    # comes would drop the whole body. Its only text-bearing child is title.
+    SKIP_TAGS = {'script', 'style', 'title', 'noscript', 'template'}
+    BLOCK_TAGS = {
+        'p', 'div', 'br', 'li', 'tr', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+        'blockquote', 'pre', 'hr', 'section', 'article', 'header', 'footer', 'ul', 'ol'
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.chunks.append(data)
+
+    def get_text(self):
+        lines = (' '.join(line.split()) for line in ''.join(self.chunks).split('\n'))
+        return '\n'.join(line for line in lines if line)
+
+def html_to_text(html):
+    extractor = HTMLTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.get_text()
+
+CHARSET_RE = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+
+def get_part_charset(part):
+    """Charset from the part's Content-Type header, or None"""
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = CHARSET_RE.search(header['value'])
+            return match.group(1).lower() if match else None
+    return None
+
+def decode_text(data, charset=None):
+    """Decode bytes using the declared charset, falling back to UTF-8 and then Windows-1252"""
+    candidates = [charset] if charset else []
+    candidates.append('utf-8')
+    for candidate in candidates:
+        try:
+            return data.decode(candidate)
+        except (LookupError, UnicodeDecodeError):
+            continue
+    return data.decode('cp1252', errors='replace')
+
+def decode_part(part):
+    # Gmail has already undone the Content-Transfer-Encoding; body.data is the raw content bytes
+    return decode_text(base64.urlsafe_b64decode(part['body']['data']), get_part_charset(part))
 
 def get_email_body(message):
-    if 'parts' in message['payload']:
-        parts = message['payload']['parts']
-        for part in parts:
-            if part['mimeType'] == 'text/plain' and 'data' in part['body']:
-                return base64.urlsafe_b64decode(part['body']['data']).decode()
-    elif 'body' in message['payload'] and 'data' in message['payload']['body']:
-        return base64.urlsafe_b64decode(message['payload']['body']['data']).decode()
+    payload = message['payload']
+    if 'parts' in payload:
+        text_parts = find_text_parts(payload)
+        if text_parts:
+            return '\n'.join(decode_part(part) for part in text_parts)
+        # HTML-only mail: fall back to the text content of the HTML parts
+        return '\n'.join(html_to_text(decode_part(part)) for part in find_text_parts(payload, 'text/html'))
+    elif 'body' in payload and 'data' in payload['body']:
+        if payload.get('mimeType') == 'text/html':
+            return html_to_text(decode_part(payload))
+        return decode_part(payload)
     return ''
 
+REPLY_HEADER_RE = re.compile(r'^On\b.{0,300}\bwrote:$', re.IGNORECASE)
+ORIGINAL_MESSAGE_RE = re.compile(r'^-{2,}\s*Original Message\s*-{2,}$', re.IGNORECASE)
+FORWARD_MARKER_RE = re.compile(r'^-{2,}\s*Forwarded message\s*-{2,}$|^Begin forwarded message:$', re.IGNORECASE)
+HEADER_LINE_RE = re.compile(r'^(From|To|Cc|Date|Sent|Subject|Reply-To):', re.IGNORECASE)
+SENT_FROM_RE = re.compile(r'^Sent from my \w+', re.IGNORECASE)
+# A bare "--" (trailing space stripped by the client) only counts as a
+# signature delimiter when this few non-blank lines follow it before any
+# quoted history
+SIGNATURE_MAX_LINES = 8
+
+def starts_quoted_history(lines, i):
+    """True if lines[i] opens a quote block, reply/forward header or Outlook original message"""
+    stripped = lines[i].strip()
+    next_stripped = lines[i + 1].strip() if i + 1 < len(lines) else ''
+    return (
+        stripped.startswith('>')
+        or bool(REPLY_HEADER_RE.match(stripped))
+        or (stripped.startswith('On ') and bool(REPLY_HEADER_RE.match(f"{stripped} {next_stripped}")))
+        or bool(FORWARD_MARKER_RE.match(stripped) or ORIGINAL_MESSAGE_RE.match(stripped))
+        or (stripped.startswith('From:') and next_stripped.startswith('Sent:'))
+    )
+
+def is_signature_delimiter(lines, i):
+    if lines[i] == '-- ':
+        return True
+    if lines[i].rstrip() != '--':
+        return False
+    signature_lines = 0
+    for j in range(i + 1, len(lines)):
+        if starts_quoted_history(lines, j):
+            break
+        if lines[j].strip():
+            signature_lines += 1
+            if signature_lines > SIGNATURE_MAX_LINES:
+                return False
+    return True
+
+def reduce_body(body):
+    """Strip text the sender didn't write before it is scored.
+
+    Drops >-quoted lines, "On ... wrote:" headers, forwarded-message header
+    blocks and "Sent from my ..." lines, and cuts everything from a "-- "
+    signature delimiter or an Outlook "Original Message"/"From: ... Sent:" header on.
+    Returns the body unchanged if nothing would be left.
+    """
+    lines = body.splitlines()
+    kept = []
+    i = 0
+    while i < len(lines):
+        stripped = lines[i].strip()
+        next_stripped = lines[i + 1].strip() if i + 1 < len(lines) else ''
+        if stripped.startswith('>'):
+            i += 1
+            continue
+        if is_signature_delimiter(lines, i) or ORIGINAL_MESSAGE_RE.match(stripped):
+            break
+        if stripped.startswith('From:') and next_stripped.startswith('Sent:'):
+            break
+        if REPLY_HEADER_RE.match(stripped):
+            i += 1
+            continue
+        # Gmail wraps long reply headers onto a second line
+        if stripped.startswith('On ') and REPLY_HEADER_RE.match(f"{stripped} {next_stripped}"):
+            i += 2
+            continue
+        if FORWARD_MARKER_RE.match(stripped):
+            i += 1
+            while i < len(lines) and HEADER_LINE_RE.match(lines[i].strip()):
+                i += 1
+            continue
+        if not SENT_FROM_RE.match(stripped):
+            kept.append(lines[i])
+        i += 1
+    reduced = '\n'.join(kept).strip()
+    return reduced or body
+
+def get_scoring_text(body):
+    return reduce_body(body) if REDUCE_BODIES else body
+
 def upsert_email(supabase, email_data):
     try:
         result = supabase.table('emails').upsert(
@@ -129,107 +1038,835 @@ def upsert_email(supabase, email_data):
         print(f"Supabase upsert error: {str(e)}")
         return None
 
-def main():
-    try:
-        usage_tracker = UsageTracker()
-        gmail = get_gmail_service()
-        supabase = create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY'))
-        print("Services initialized successfully")
+def normalize_body(text):
+    """Collapse whitespace so formatting-only differences hash the same"""
+    return ' '.join(text.split())
 
-        query = ' OR '.join(f'from:{domain}' for domain in ALLOWED_DOMAINS)
-        results = gmail.users().messages().list(userId='me', q=query, maxResults=50).execute()
-        messages = results.get('messages', [])
-        
+def body_hash(text):
+    return hashlib.sha256(normalize_body(text).encode('utf-8')).hexdigest()
+
+class ScoreCache:
+    """SQLite cache of GPTZero scores keyed by normalized-body hash, LRU-evicted"""
+    def __init__(self, path=SCORE_CACHE_PATH, max_entries=SCORE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS scores ('
+            'body_hash TEXT PRIMARY KEY, ai REAL NOT NULL, human REAL NOT NULL, last_used REAL NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)')
+        self.conn.commit()
+        self.size = self.conn.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+
+    def get(self, text):
+        """Return cached (ai, human) for text, or None"""
+        key = body_hash(text)
+        with self.lock:
+            row = self.conn.execute('SELECT ai, human FROM scores WHERE body_hash = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE scores SET last_used = ? WHERE body_hash = ?', (time.time(), key))
+            self.conn.commit()
+            return row
+
+    def put(self, text, ai, human):
+        key = body_hash(text)
+        with self.lock:
+            inserted = self.conn.execute(
+                'INSERT OR IGNORE INTO scores (body_hash, ai, human, last_used) VALUES (?, ?, ?, ?)',
+                (key, ai, human, time.time())
+            ).rowcount
+            self.size += inserted
+            if self.size > self.max_entries:
+                excess = self.size - self.max_entries
+                self.conn.execute(
+                    'DELETE FROM scores WHERE body_hash IN '
+                    '(SELECT body_hash FROM scores ORDER BY last_used LIMIT ?)',
+                    (excess,)
+                )
+                self.size -= excess
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+class PayloadCache:
+    """SQLite store of zlib-compressed Gmail payloads, LRU-evicted past max_bytes.
+
+    Rows are keyed by a hash of the message ID and the field mask in effect,
+    so changing GMAIL_FIELD_MASK never serves a payload missing fields.
+    """
+    def __init__(self, path=PAYLOAD_CACHE_PATH, max_bytes=PAYLOAD_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.fields = GMAIL_FULL_FIELDS if GMAIL_FIELD_MASK else '*'
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS payloads ('
+            'key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS payloads_last_used ON payloads (last_used)')
+        self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM payloads').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, message_id):
+        return hashlib.sha256(f"{message_id}\0{self.fields}".encode('utf-8')).hexdigest()
+
+    def get_many(self, message_ids):
+        """Return {message_id: message} for the IDs that are cached"""
+        keys = {self.key(message_id): message_id for message_id in message_ids}
+        messages = {}
+        with self.lock:
+            for batch in chunked(keys, 500):
+                rows = self.conn.execute(
+                    f"SELECT key, data FROM payloads WHERE key IN ({','.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+                for key, data in rows:
+                    messages[keys[key]] = json.loads(zlib.decompress(data))
+            if messages:
+                now = time.time()
+                self.conn.executemany(
+                    'UPDATE payloads SET last_used = ? WHERE key = ?',
+                    [(now, self.key(message_id)) for message_id in messages]
+                )
+                self.conn.commit()
+            self.hits += len(messages)
+            self.misses += len(keys) - len(messages)
+        return messages
+
+    def put_many(self, messages):
+        """Store {message_id: message} and evict least recently used rows over max_bytes"""
         if not messages:
-            print("No matching emails found")
             return
-            
-        print(f"Found {len(messages)} emails to process")
-        
-        stats = {
+        now = time.time()
+        with self.lock:
+            for message_id, message in messages.items():
+                data = zlib.compress(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+                key = self.key(message_id)
+                row = self.conn.execute('SELECT size FROM payloads WHERE key = ?', (key,)).fetchone()
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO payloads (key, data, size, last_used) VALUES (?, ?, ?, ?)',
+                    (key, data, len(data), now)
+                )
+                self.total_bytes += len(data) - (row[0] if row else 0)
+            if self.total_bytes > self.max_bytes:
+                evict = []
+                for key, size in self.conn.execute('SELECT key, size FROM payloads ORDER BY last_used'):
+                    if self.total_bytes <= self.max_bytes:
+                        break
+                    evict.append((key,))
+                    self.total_bytes -= size
+                self.conn.executemany('DELETE FROM payloads WHERE key = ?', evict)
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+SIMHASH_BITS = 64
+# Bands narrower than this match most of the table and stop narrowing lookups
+SIMHASH_MIN_BAND_BITS = 4
+SHINGLE_TOKEN_RE = re.compile(r'\w+')
+
+def simhash(text, shingle_size=3):
+    """64-bit SimHash over word shingles, with digits folded so numbers don't separate templates"""
+    tokens = SHINGLE_TOKEN_RE.findall(re.sub(r'\d', '0', text.lower()))
+    if len(tokens) < shingle_size:
+        tokens = tokens + [''] * (shingle_size - len(tokens))
+    hashes = [
+        int.from_bytes(hashlib.blake2b(' '.join(tokens[i:i + shingle_size]).encode('utf-8'), digest_size=8).digest(), 'big')
+        for i in range(len(tokens) - shingle_size + 1)
+    ]
+    # A bit is set when most shingle hashes have it set; counting down the
+    # columns of the binary strings keeps the per-bit loop out of Python
+    half = len(hashes) / 2
+    columns = zip(*(format(h, '064b') for h in hashes))
+    return sum(1 << (SIMHASH_BITS - 1 - i) for i, column in enumerate(columns) if column.count('1') > half)
+
+def simhash_bands(fingerprint, bands):
+    """Split a fingerprint into `bands` contiguous, near-equal bit ranges"""
+    bounds = [band * SIMHASH_BITS // bands for band in range(bands + 1)]
+    return [fingerprint >> low & ((1 << (high - low)) - 1) for low, high in zip(bounds, bounds[1:])]
+
+def to_signed64(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+class NearDuplicateIndex:
+    """Persistent SimHash index of scored bodies.
+
+    Fingerprints are split into max_distance + 1 bands, each indexed, so any
+    stored fingerprint within max_distance bits of a query shares at least
+    one band with it and is found without scanning the table. The bands are
+    rebuilt when max_distance changes between runs. A negative max_distance
+    disables lookups while still recording fingerprints.
+    """
+    def __init__(self, path=NEAR_DUP_INDEX_PATH, max_distance=NEAR_DUP_MAX_DISTANCE):
+        max_bands = SIMHASH_BITS // SIMHASH_MIN_BAND_BITS
+        if max_distance >= max_bands:
+            raise ValueError(f"NEAR_DUP_MAX_DISTANCE must be below {max_bands}")
+        self.max_distance = max_distance
+        self.bands = max(max_distance, 0) + 1
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprints ('
+            'fingerprint INTEGER PRIMARY KEY, ai REAL NOT NULL, human REAL NOT NULL)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprint_bands ('
+            'band INTEGER NOT NULL, value INTEGER NOT NULL, fingerprint INTEGER NOT NULL, '
+            'PRIMARY KEY (band, value, fingerprint)) WITHOUT ROWID'
+        )
+        # user_version records the band count the band table was built with
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] != self.bands:
+            self.conn.execute('DELETE FROM fingerprint_bands')
+            stored = [row[0] for row in self.conn.execute('SELECT fingerprint FROM fingerprints')]
+            self.conn.executemany(
+                'INSERT INTO fingerprint_bands (band, value, fingerprint) VALUES (?, ?, ?)',
+                [row for fingerprint in stored for row in self._band_rows(fingerprint)]
+            )
+            self.conn.execute(f'PRAGMA user_version = {self.bands}')
+        self.conn.commit()
+
+    def _band_rows(self, signed_fingerprint):
+        fingerprint = signed_fingerprint & ((1 << SIMHASH_BITS) - 1)
+        return [
+            (band, value, signed_fingerprint)
+            for band, value in enumerate(simhash_bands(fingerprint, self.bands))
+        ]
+
+    def lookup(self, text):
+        """Return (ai, human) interpolated from stored bodies within max_distance bits, or None"""
+        if self.max_distance < 0:
+            return None
+        fingerprint = simhash(text)
+        candidates = {}
+        with self.lock:
+            for band, value in enumerate(simhash_bands(fingerprint, self.bands)):
+                rows = self.conn.execute(
+                    'SELECT f.fingerprint, f.ai, f.human FROM fingerprint_bands b '
+                    'JOIN fingerprints f ON f.fingerprint = b.fingerprint '
+                    'WHERE b.band = ? AND b.value = ?',
+                    (band, value)
+                )
+                candidates.update((row[0], row) for row in rows)
+        # Closer matches weigh more; an identical fingerprint dominates
+        total_weight = ai = human = 0.0
+        for stored, stored_ai, stored_human in candidates.values():
+            distance = bin((stored & ((1 << 64) - 1)) ^ fingerprint).count('1')
+            if distance <= self.max_distance:
+                weight = self.max_distance + 1 - distance
+                total_weight += weight
+                ai += weight * stored_ai
+                human += weight * stored_human
+        if not total_weight:
+            return None
+        return ai / total_weight, human / total_weight
+
+    def add(self, text, ai, human):
+        signed_fingerprint = to_signed64(simhash(text))
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO fingerprints (fingerprint, ai, human) VALUES (?, ?, ?)',
+                (signed_fingerprint, ai, human)
+            )
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO fingerprint_bands (band, value, fingerprint) VALUES (?, ?, ?)',
+                self._band_rows(signed_fingerprint)
+            )
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+class EmailWriter:
+    """Buffer email rows and upsert them in batches"""
+    def __init__(self, supabase, flush_size=UPSERT_BATCH_SIZE, flush_interval=UPSERT_FLUSH_SECONDS):
+        self.supabase = supabase
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.lock = threading.Lock()
+
+    def add(self, email_data):
+        with self.lock:
+            self.buffer.append(email_data)
+            due = len(self.buffer) >= self.flush_size or time.monotonic() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            rows, self.buffer = self.buffer, []
+            self.last_flush = time.monotonic()
+        if not rows:
+            return
+        written = failed = 0
+        # A bulk upsert needs every row to carry the same columns
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for group in groups.values():
+            try:
+                self.supabase.table('emails').upsert(group, on_conflict='message_id').execute()
+                written += len(group)
+            except Exception as e:
+                print(f"Supabase batch upsert error, retrying {len(group)} rows individually: {str(e)}")
+                for row in group:
+                    if upsert_email(self.supabase, row):
+                        written += 1
+                    else:
+                        failed += 1
+        # Workers can flush concurrently in async mode
+        with self.lock:
+            self.rows_written += written
+            self.rows_failed += failed
+        print(f"✓ Saved {written}/{len(rows)} emails")
+
+    def close(self):
+        self.flush()
+
+class RateLimiter:
+    """Space calls at least 1/rate seconds apart; safe to share between threads"""
+    def __init__(self, rate=GPTZERO_RATE_LIMIT):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve_delay(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+            return slot - now
+
+    def defer(self, seconds):
+        """Hold every caller back for at least `seconds`, e.g. after a Retry-After"""
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+    def wait(self):
+        delay = self._reserve_delay()
+        if delay > 0:
+            time.sleep(delay)
+
+class RetryQueue:
+    """Emails deferred after a 429, retried with backoff once the main pass is done"""
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.heap = []
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+
+    def backoff(self, attempt, retry_after=None):
+        """Full-jitter exponential backoff, never shorter than Retry-After"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    def defer(self, item, attempt, retry_after=None):
+        """Queue item for another attempt; returns the delay, or None when out of attempts"""
+        if attempt + 1 >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt, retry_after)
+        with self.lock:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.seq), item, attempt + 1))
+        return delay
+
+    def __len__(self):
+        return len(self.heap)
+
+    def drain(self, handler, should_stop=lambda: False, before_wait=None):
+        """Call handler(*item, attempt=n) for each deferred item in ready-time order.
+
+        before_wait, if given, is called before sleeping until the next item is ready.
+        """
+        while self.heap and not should_stop():
+            with self.lock:
+                ready_at, _, item, attempt = heapq.heappop(self.heap)
+            delay = ready_at - time.monotonic()
+            if delay > 0:
+                if before_wait:
+                    before_wait()
+                time.sleep(delay)
+            handler(*item, attempt=attempt)
+
+class EmailProcessor:
+    """Score fetched messages and queue them for persistence"""
+    def __init__(self, usage_tracker, gptzero, writer, rate_limiter, score_cache, near_dup_index,
+                 filter_senders=False, payload_cache=None):
+        self.usage_tracker = usage_tracker
+        self.gptzero = gptzero
+        self.score_cache = score_cache
+        self.near_dup_index = near_dup_index
+        self.payload_cache = payload_cache
+        self.writer = writer
+        self.rate_limiter = rate_limiter
+        self.filter_senders = filter_senders
+        self.retry_queue = RetryQueue()
+        self.limit_reached = False
+        self.lock = threading.Lock()
+        self.stats = {
+            'found': 0,
             'processed': 0,
             'skipped_existing': 0,
             'skipped_rate_limit': 0,
+            'skipped_budget': 0,
+            'skipped_prefilter': 0,
+            'skipped_empty': 0,
+            'deferred': 0,
+            'cache_hits': 0,
+            'near_duplicate_hits': 0,
+            'words_saved': 0,
             'errors': 0
         }
-        
-        for i, message_meta in enumerate(messages, 1):
-            try:
-                message_id = message_meta['id']
-                exists, has_scores = check_email_exists(supabase, message_id)
-                
-                if exists and has_scores:
-                    print(f"\nEmail {i}/{len(messages)} - SKIPPED (already processed)")
-                    stats['skipped_existing'] += 1
-                    continue
-                
-                message = gmail.users().messages().get(userId='me', id=message_id, format='full').execute()
-                headers = message['payload']['headers']
-                sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
-                body = get_email_body(message)
-                
-                if not body:
-                    print(f"\nEmail {i}/{len(messages)} - SKIPPED (no content)")
-                    stats['errors'] += 1
-                    continue
 
-                print(f"\nEmail {i}/{len(messages)} - Processing...")
-                print(f"From: {sender}")
-                
-                # Check word count before making API call
-                words = count_words(body)
-                total_after = usage_tracker.word_count + words
-                if total_after > usage_tracker.word_limit:
-                    print(f"WARNING: Processing this email would exceed the word limit")
+    def retry_deferred(self):
+        """Re-attempt emails deferred by 429s before the run ends"""
+        if len(self.retry_queue):
+            print(f"\nRetrying {len(self.retry_queue)} deferred emails")
+        # Don't leave rows sitting in the buffer while the queue waits out backoffs
+        self.writer.flush()
+        self.retry_queue.drain(self.process, should_stop=lambda: self.limit_reached, before_wait=self.writer.flush)
+
+    def lookup_cached_score(self, text, words):
+        """Return ((ai, human), stats key) from the exact cache or a near-duplicate, or (None, None)"""
+        cached = self.score_cache.get(text)
+        if cached is not None:
+            return cached, 'cache_hits'
+        if words >= NEAR_DUP_MIN_WORDS:
+            near = self.near_dup_index.lookup(text)
+            if near is not None:
+                return near, 'near_duplicate_hits'
+        return None, None
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def process(self, n, message_id, message, exists, has_scores, attempt=0):
+        try:
+            if message is None:
+                print(f"\nEmail {n} - SKIPPED (fetch failed)")
+                self.count('errors')
+                return
+
+            sender = get_sender(message)
+            if self.filter_senders and not sender_allowed(sender):
+                return
+            body = get_email_body(message)
+
+            if not body:
+                print(f"\nEmail {n} - SKIPPED (no content)")
+                self.count('skipped_empty')
+                return
+
+            print(f"\nEmail {n} - Processing...")
+            print(f"From: {sender}")
+
+            # Only the text the sender wrote is scored; the full body is stored
+            text = get_scoring_text(body)
+
+            usage_tracker = self.usage_tracker
+            words = usage_tracker.count_words(text)
+
+            # Duplicate and near-duplicate bodies reuse an earlier score and cost no words
+            cached, cache_kind = (None, None) if has_scores else self.lookup_cached_score(text, words)
+
+            # Reserve the words before making the API call; the check and the
+            # increment are one atomic step, so parallel workers can't overshoot
+            reservation = None
+            if cached is None and not has_scores:
+                try:
+                    reservation = usage_tracker.reserve(words)
+                except WordLimitExceeded:
+                    # Skip rather than stop: a smaller email later on may still fit
+                    total_after = usage_tracker.word_count + words
+                    print(f"SKIPPED: Processing this email would exceed the word limit")
                     print(f"Current total: {usage_tracker.word_count:,}")
                     print(f"This email: {words:,} words")
                     print(f"Would exceed limit by: {total_after - usage_tracker.word_limit:,} words")
-                    break
+                    self.count('skipped_budget')
+                    if usage_tracker.word_count >= usage_tracker.word_limit:
+                        self.limit_reached = True
+                    return
 
-                email_data = {
-                    'message_id': message_id,
-                    'sender': sender,
-                    'body': body
-                }
-
-                if not has_scores:
-                    ai_score, human_score = get_gptzero_scores(body, usage_tracker)
-                    if ai_score is not None and human_score is not None:
-                        email_data.update({
-                            'gpt_zero_ai': ai_score,
-                            'gpt_zero_human': human_score
-                        })
-                        stats['processed'] += 1
-                    else:
-                        stats['skipped_rate_limit'] += 1
-
-                result = upsert_email(supabase, email_data)
-                if result:
-                    action = 'Updated' if exists else 'Inserted'
-                    scores_msg = f" (AI: {ai_score:.2f}, Human: {human_score:.2f})" if 'gpt_zero_ai' in email_data else " (without scores)"
-                    print(f"✓ {action} email{scores_msg}")
-                
-                time.sleep(2)
-                
-            except Exception as e:
-                print(f"Error processing email {i}: {str(e)}")
-                stats['errors'] += 1
+            email_data = {
+                'message_id': message_id,
+                'sender': sender,
+                'body': body
+            }
+
+            if not has_scores and cached is not None:
+                ai_score, human_score = cached
+                email_data.update({
+                    'gpt_zero_ai': ai_score,
+                    'gpt_zero_human': human_score
+                })
+                print("Score cache hit" if cache_kind == 'cache_hits' else "Near-duplicate score reused")
+                self.count(cache_kind)
+            elif not has_scores:
+                self.rate_limiter.wait()
+                try:
+                    ai_score, human_score = get_gptzero_scores(text, usage_tracker, self.gptzero, reservation)
+                except RateLimited as e:
+                    item = (n, message_id, message, exists, has_scores)
+                    delay = self.retry_queue.defer(item, attempt, e.retry_after)
+                    if delay is not None:
+                        self.rate_limiter.defer(e.retry_after or delay)
+                        print(f"Deferred for retry in {delay:.1f}s (attempt {attempt + 1})")
+                        self.count('deferred')
+                        return
+                    print(f"Giving up after {attempt + 1} attempts")
+                    ai_score, human_score = None, None
+                if ai_score is not None and human_score is not None:
+                    email_data.update({
+                        'gpt_zero_ai': ai_score,
+                        'gpt_zero_human': human_score
+                    })
+                    self.score_cache.put(text, ai_score, human_score)
+                    self.near_dup_index.add(text, ai_score, human_score)
+                    self.count('processed')
+                    if text != body:
+                        self.count('words_saved', usage_tracker.count_words(body) - words)
+                else:
+                    self.count('skipped_rate_limit')
+
+            self.writer.add(email_data)
+            action = 'update' if exists else 'insert'
+            scores_msg = f" (AI: {ai_score:.2f}, Human: {human_score:.2f})" if 'gpt_zero_ai' in email_data else " (without scores)"
+            print(f"Queued {action}{scores_msg}")
+
+        except Exception as e:
+            print(f"Error processing email {n}: {str(e)}")
+            self.count('errors')
+
+def filter_pending(supabase, processor, message_ids):
+    """Number a page of IDs and return (n, message_id, exists, has_scores) for those still needing scores"""
+    pending = []
+    existing = check_emails_exist(supabase, message_ids)
+    for message_id in message_ids:
+        processor.stats['found'] += 1
+        exists, has_scores = existing[message_id]
+
+        if exists and has_scores:
+            print(f"\nEmail {processor.stats['found']} - SKIPPED (already processed)")
+            processor.stats['skipped_existing'] += 1
+            continue
+
+        pending.append((processor.stats['found'], message_id, exists, has_scores))
+    return pending
+
+def prefilter_candidates(gmail, processor, message_ids):
+    """Rank and filter IDs from metadata alone, before any format='full' fetch.
+
+    One metadata fetch (From header and sizeEstimate) per message drops
+    senders outside ALLOWED_DOMAINS when the listing wasn't narrowed by the
+    search query, and with GMAIL_PREFILTER also drops automated senders and
+    messages over PREFILTER_MAX_BYTES. sizeEstimate counts headers,
+    attachments and markup, so it isn't used to guess word counts; the word
+    budget is checked once the body has been read. Survivors come back
+    smallest first. IDs whose metadata couldn't be fetched are kept so the
+    full fetch decides.
+    """
+    metadata = fetch_messages(gmail, message_ids, 'metadata')
+    kept = []
+    for message_id in message_ids:
+        meta = metadata.get(message_id)
+        if meta is None:
+            kept.append((0, message_id))
+            continue
+        sender = get_sender(meta)
+        size = int(meta.get('sizeEstimate', 0))
+        if processor.filter_senders and not sender_allowed(sender):
+            continue
+        if GMAIL_PREFILTER:
+            if any(pattern in sender.lower() for pattern in AUTOMATED_SENDERS):
+                reason = 'automated sender'
+            elif PREFILTER_MAX_BYTES and size > PREFILTER_MAX_BYTES:
+                reason = f'{size:,} bytes'
+            else:
+                reason = None
+            if reason:
+                print(f"Prefilter: {message_id} SKIPPED ({reason})")
+                processor.count('skipped_prefilter')
                 continue
-        
+        kept.append((size, message_id))
+    kept.sort()
+    return [message_id for _, message_id in kept]
+
+def iter_pages(gmail, supabase, processor, message_ids, prefilter=True):
+    """Yield pages of (n, message_id, message, exists, has_scores) that still need scoring.
+
+    Pass prefilter=False for IDs plan_message_ids already prefiltered, so they
+    aren't charged a second metadata fetch or re-sorted out of plan order.
+    """
+    for page in chunked(message_ids, GMAIL_BATCH_SIZE):
+        pending = filter_pending(supabase, processor, page)
+        if prefilter and (processor.filter_senders or GMAIL_PREFILTER):
+            ranked = prefilter_candidates(gmail, processor, [message_id for _, message_id, _, _ in pending])
+            by_id = {item[1]: item for item in pending}
+            pending = [by_id[message_id] for message_id in ranked]
+        messages = fetch_messages(
+            gmail, [message_id for _, message_id, _, _ in pending], payload_cache=processor.payload_cache
+        )
+        yield [
+            (n, message_id, messages.get(message_id), exists, has_scores)
+            for n, message_id, exists, has_scores in pending
+        ]
+
+def iter_offline_pages(supabase, processor, messages):
+    """Like iter_pages, for (message_id, message) pairs already read from an archive"""
+    for page in chunked(messages, GMAIL_BATCH_SIZE):
+        by_id = dict(page)
+        pending = filter_pending(supabase, processor, list(by_id))
+        yield [
+            (n, message_id, by_id[message_id], exists, has_scores)
+            for n, message_id, exists, has_scores in pending
+        ]
+
+BUDGET_OBJECTIVES = ('count', 'recency', 'sender')
+
+def check_budget_objective(objective):
+    if objective not in BUDGET_OBJECTIVES:
+        raise ValueError(f"Unknown BUDGET_OBJECTIVE: {objective}")
+
+def plan_budget(candidates, budget, objective=BUDGET_OBJECTIVE, priority_senders=PRIORITY_SENDERS):
+    """Choose which candidates to score so their words fit within budget.
+
+    'count' takes the smallest emails first, which maximizes how many fit;
+    'recency' takes the newest first; 'sender' takes PRIORITY_SENDERS first,
+    newest first within each group. Emails that don't fit are passed over
+    instead of ending the selection.
+    """
+    if objective == 'count':
+        key = lambda c: c['words']
+    elif objective == 'recency':
+        key = lambda c: -c['internal_date']
+    elif objective == 'sender':
+        key = lambda c: (
+            not any(p in c['sender'].lower() for p in priority_senders),
+            -c['internal_date']
+        )
+    else:
+        raise ValueError(f"Unknown BUDGET_OBJECTIVE: {objective}")
+
+    selected = []
+    used = 0
+    for candidate in sorted(candidates, key=key):
+        if used + candidate['words'] <= budget:
+            selected.append(candidate)
+            used += candidate['words']
+    return selected, used
+
+def plan_message_ids(gmail, supabase, processor, message_ids, objective=BUDGET_OBJECTIVE):
+    """Size every candidate up front and return the IDs plan_budget selects, in order"""
+    # Fail before fetching the whole mailbox, not after
+    check_budget_objective(objective)
+    candidates = []
+    for page in chunked(message_ids, GMAIL_BATCH_SIZE):
+        existing = check_emails_exist(supabase, page)
+        pending = [message_id for message_id in page if existing[message_id] != (True, True)]
+        processor.stats['skipped_existing'] += len(page) - len(pending)
+        if processor.filter_senders or GMAIL_PREFILTER:
+            pending = prefilter_candidates(gmail, processor, pending)
+        messages = fetch_messages(gmail, pending, payload_cache=processor.payload_cache)
+        # Unfetched messages must hold the history checkpoint back like they do in process()
+        processor.count('errors', len(pending) - len(messages))
+        for message_id, message in messages.items():
+            sender = get_sender(message)
+            if processor.filter_senders and not sender_allowed(sender):
+                continue
+            body = get_email_body(message)
+            if not body:
+                processor.count('skipped_empty')
+                continue
+            text = get_scoring_text(body)
+            words = processor.usage_tracker.count_words(text)
+            cached, _ = processor.lookup_cached_score(text, words)
+            candidates.append({
+                'message_id': message_id,
+                'sender': sender,
+                'internal_date': int(message.get('internalDate', 0)),
+                'words': 0 if cached is not None else words
+            })
+
+    usage_tracker = processor.usage_tracker
+    budget = max(0, usage_tracker.word_limit - usage_tracker.word_count)
+    selected, planned_words = plan_budget(candidates, budget, objective)
+    processor.stats['skipped_budget'] += len(candidates) - len(selected)
+    print(f"Planned {len(selected)} of {len(candidates)} candidates "
+          f"({planned_words:,} of {budget:,} remaining words, objective: {objective})")
+    return [candidate['message_id'] for candidate in selected]
+
+def run_sequential(processor, pages):
+    for items in pages:
+        for item in items:
+            processor.process(*item)
+            if processor.limit_reached:
+                return
+
+async def run_async(processor, pages, concurrency=SCORING_CONCURRENCY):
+    """Fetch the next page while up to `concurrency` emails are scored and persisted"""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+    # The default executor caps out at min(32, cpus + 4) threads; size our own
+    # so every scoring slot plus the page fetcher gets a thread
+    executor = ThreadPoolExecutor(max_workers=concurrency + 1)
+
+    async def score(item):
+        try:
+            await loop.run_in_executor(executor, lambda: processor.process(*item))
+        finally:
+            semaphore.release()
+
+    try:
+        while not processor.limit_reached:
+            items = await loop.run_in_executor(executor, next, pages, None)
+            if items is None:
+                break
+            for item in items:
+                await semaphore.acquire()
+                if processor.limit_reached:
+                    semaphore.release()
+                    break
+                task = asyncio.create_task(score(item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        await asyncio.gather(*tasks)
+    finally:
+        executor.shutdown(wait=True)
+
+def main():
+    try:
+        if BUDGET_OBJECTIVE:
+            check_budget_objective(BUDGET_OBJECTIVE)
+        usage_ledger = UsageLedger()
+        usage_tracker = UsageTracker(ledger=usage_ledger)
+        # Archive backfills don't touch the Gmail API at all
+        gmail = None if OFFLINE_SOURCE else get_gmail_service()
+        supabase = create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY'))
+        writer = EmailWriter(supabase)
+        gptzero = GPTZeroClient()
+        score_cache = ScoreCache()
+        near_dup_index = NearDuplicateIndex()
+        payload_cache = PayloadCache() if gmail and PAYLOAD_CACHE_MAX_BYTES > 0 else None
+        print("Services initialized successfully")
+
+        query = ' OR '.join(f'from:{domain}' for domain in ALLOWED_DOMAINS)
+        sync_history = SYNC_MODE == 'incremental' and not OFFLINE_SOURCE
+        start_history_id = get_current_history_id(gmail) if sync_history else None
+        checkpoint = load_history_checkpoint() if sync_history else None
+        incremental = checkpoint is not None
+
+        if incremental:
+            print(f"Incremental sync from historyId {checkpoint}")
+            message_ids = list_added_message_ids(gmail, checkpoint)
+            try:
+                first_id = next(message_ids, None)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                print("History checkpoint expired, falling back to full sync")
+                incremental = False
+            else:
+                if first_id is not None:
+                    message_ids = itertools.chain([first_id], message_ids)
+        if OFFLINE_SOURCE:
+            print(f"Reading archived messages from {OFFLINE_SOURCE}")
+        elif not incremental:
+            message_ids = list_message_ids(gmail, query)
+
+        processor = EmailProcessor(
+            usage_tracker, gptzero, writer, RateLimiter(), score_cache, near_dup_index,
+            filter_senders=incremental, payload_cache=payload_cache
+        )
+        try:
+            if OFFLINE_SOURCE:
+                if BUDGET_OBJECTIVE:
+                    print("BUDGET_OBJECTIVE is ignored for archive sources; emails are taken in archive order")
+                pages = iter_offline_pages(supabase, processor, iter_offline_messages(OFFLINE_SOURCE))
+            else:
+                if BUDGET_OBJECTIVE:
+                    message_ids = plan_message_ids(gmail, supabase, processor, message_ids)
+                pages = iter_pages(gmail, supabase, processor, message_ids, prefilter=not BUDGET_OBJECTIVE)
+            if PIPELINE_MODE == 'async':
+                asyncio.run(run_async(processor, pages))
+            else:
+                run_sequential(processor, pages)
+            processor.retry_deferred()
+        finally:
+            writer.close()
+            gptzero.close()
+            score_cache.close()
+            near_dup_index.close()
+            if payload_cache:
+                payload_cache.close()
+            usage_ledger.close()
+
+        # Anything that failed or was saved without scores has to be listed
+        # again by the next incremental run, so the checkpoint stays put
+        run_complete = (
+            not processor.limit_reached
+            and not len(processor.retry_queue)
+            and not any(processor.stats[key] for key in ('skipped_budget', 'skipped_rate_limit', 'errors'))
+            and not writer.rows_failed
+        )
+        if sync_history and run_complete:
+            save_history_checkpoint(start_history_id)
+
+        stats = processor.stats
+        if stats['found'] == 0 and stats['skipped_existing'] == 0:
+            print("No matching emails found")
+            return
+
         # Print final stats
         print("\nProcessing Complete!")
+        print(f"Emails found: {stats['found']}")
         print(f"Processed: {stats['processed']}")
         print(f"Skipped (existing): {stats['skipped_existing']}")
         print(f"Skipped (rate limit): {stats['skipped_rate_limit']}")
+        print(f"Skipped (word budget): {stats['skipped_budget']}")
+        print(f"Skipped (prefilter): {stats['skipped_prefilter']}")
+        print(f"Skipped (no content): {stats['skipped_empty']}")
+        print(f"Deferred for retry: {stats['deferred']}")
+        print(f"Score cache hits: {stats['cache_hits']}")
+        print(f"Near-duplicate hits: {stats['near_duplicate_hits']}")
         print(f"Errors: {stats['errors']}")
+        print(f"Failed writes: {writer.rows_failed}")
+        if gmail:
+            print(f"Gmail quota bucket: {gmail_bucket.fill_level() * 100:.0f}% full, "
+                  f"{gmail_bucket.waited:.1f}s spent waiting for quota")
+        if payload_cache:
+            print(f"Gmail payload cache: {payload_cache.hits} hits, {payload_cache.misses} fetched, "
+                  f"{payload_cache.total_bytes / 1024 / 1024:.1f} MiB on disk")
         
         # Print usage stats
         final_stats = usage_tracker.get_stats()
         print("\nWord Usage Statistics:")
-        print(f"Total words processed: {final_stats['total_words']:,}")
+        print(f"Words processed this run: {final_stats['run_words']:,}")
+        print(f"Words used this billing period: {final_stats['total_words']:,}")
+        print(f"Words saved by stripping quotes/signatures: {stats['words_saved']:,}")
         print(f"Words remaining in limit: {final_stats['words_remaining']:,}")
         print(f"Percentage of limit used: {final_stats['percentage_used']:.1f}%")
         print(f"Average words per email: {final_stats['average_words_per_email']:.0f}")
+
+        reconciliation = usage_tracker.get_reconciliation()
+        if reconciliation['calls']:
+            print(f"\nWord Count Reconciliation ({reconciliation['strategy']} strategy):")
+            print(f"Responses reporting usage: {reconciliation['calls']}")
+            print(f"Our count: {reconciliation['counted_words']:,}")
+            print(f"GPTZero reported: {reconciliation['billed_words']:,}")
+            print(f"Drift: {reconciliation['drift_words']:+,} words ({reconciliation['drift_percentage']:+.1f}%)")
         
     except Exception as e:
         print(f"Fatal error: {str(e)}")
@@ -0,0 +1,16 @@
+import importlib.util
+import os
+
+# The script checks these at import time; placeholders are enough to load it
+for var in ['OAUTH_CLIENT_ID', 'OAUTH_CLIENT_SECRET', 'SUPABASE_URL', 'SUPABASE_KEY', 'ALLOWED_DOMAINS']:
+    os.environ.setdefault(var, 'test')
+
+
+def load_email_parser():
+    """Import email-parser.py, whose hyphenated name rules out a plain import"""
+    spec = importlib.util.spec_from_file_location(
+        'email_parser', os.path.join(os.path.dirname(__file__), '..', 'email-parser.py')
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
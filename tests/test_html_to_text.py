@@ -0,0 +1,38 @@
+import unittest
+
+from helpers import load_email_parser
+
+email_parser = load_email_parser()
+html_to_text = email_parser.html_to_text
+
+
+class HtmlToTextTest(unittest.TestCase):
+    def test_head_without_end_tag_keeps_body(self):
+        html = '<html><head><meta charset="utf-8"><body><p>Hello</p></body></html>'
+        self.assertEqual(html_to_text(html), 'Hello')
+
+    def test_head_title_is_dropped(self):
+        html = '<html><head><title>Newsletter</title></head><body>Hi there</body></html>'
+        self.assertEqual(html_to_text(html), 'Hi there')
+
+    def test_script_and_style_are_dropped(self):
+        html = (
+            '<style>p { color: red; }</style>'
+            '<p>Visible</p>'
+            '<script>var hidden = "text";</script>'
+            '<noscript>Enable JavaScript</noscript>'
+            '<p>Also visible</p>'
+        )
+        self.assertEqual(html_to_text(html), 'Visible\nAlso visible')
+
+    def test_style_in_head_without_end_tag(self):
+        html = '<head><style>.x { margin: 0 }</style><body><div>Body text</div>'
+        self.assertEqual(html_to_text(html), 'Body text')
+
+    def test_blocks_break_lines_and_entities_decode(self):
+        html = '<div>One &amp; two</div><div>three<br>four</div>'
+        self.assertEqual(html_to_text(html), 'One & two\nthree\nfour')
+
+
+if __name__ == '__main__':
+    unittest.main()
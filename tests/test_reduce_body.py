@@ -0,0 +1,56 @@
+import unittest
+
+from helpers import load_email_parser
+
+email_parser = load_email_parser()
+reduce_body = email_parser.reduce_body
+
+REPLY = 'Thanks, the numbers look right to me.\nLet us ship it on Friday.'
+SIGNATURE = 'Bob Smith\nHead of Sales\nACME Corp'
+
+
+class ReduceBodyTest(unittest.TestCase):
+    def test_bare_delimiter_above_long_quoted_history(self):
+        quoted = '\n'.join(f'> quoted line {n}' for n in range(20))
+        body = f"{REPLY}\n--\n{SIGNATURE}\n\nOn Mon, Jan 6, 2025 at 9:00 AM Alice <alice@example.com> wrote:\n{quoted}"
+        self.assertEqual(reduce_body(body), REPLY)
+
+    def test_standard_delimiter_always_cuts(self):
+        body = f"{REPLY}\n-- \n{SIGNATURE}\n" + '\n'.join(f'more footer {n}' for n in range(20))
+        self.assertEqual(reduce_body(body), REPLY)
+
+    def test_bare_separator_inside_own_text_is_kept(self):
+        rest = '\n'.join(f'Point {n} of the proposal.' for n in range(12))
+        body = f"Summary first.\n--\n{rest}"
+        self.assertEqual(reduce_body(body), body)
+
+    def test_gmail_wrapped_reply_header(self):
+        body = (
+            f"{REPLY}\n\n"
+            "On Mon, Jan 6, 2025 at 9:00 AM Alice Example <alice@example.com>\n"
+            "wrote:\n"
+            "> Can you check the numbers?\n"
+        )
+        self.assertEqual(reduce_body(body), REPLY)
+
+    def test_outlook_from_sent_header_cuts(self):
+        body = (
+            f"{REPLY}\n\n"
+            "From: Alice Example <alice@example.com>\n"
+            "Sent: Monday, January 6, 2025 9:00 AM\n"
+            "To: Bob Smith\n"
+            "Subject: Numbers\n\n"
+            "Can you check the numbers?"
+        )
+        self.assertEqual(reduce_body(body), REPLY)
+
+    def test_sent_from_line_is_dropped(self):
+        self.assertEqual(reduce_body(f"{REPLY}\n\nSent from my iPhone"), REPLY)
+
+    def test_nothing_left_returns_body(self):
+        body = '> only quoted text\n> nothing else'
+        self.assertEqual(reduce_body(body), body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import re
+import unittest
+
+from helpers import load_email_parser
+
+email_parser = load_email_parser()
+
+
+def reference_count(text):
+    """The original word count count_words must keep matching"""
+    return len(re.findall(r'\b\w+\b', text))
+
+
+class CountWordsParityTest(unittest.TestCase):
+    CASES = [
+        '',
+        '   \n\t ',
+        'Hello, world!',
+        "don't won't it's rock'n'roll y'all",
+        'See https://example.com/path?q=1&r=two#frag or mailto:bob@example.com',
+        'Version 2.0.1 costs $1,234.56 (approx. 10%)',
+        'snake_case and CamelCase and __dunder__',
+        '日本語のテキストです。中文文本。한국어 텍스트',
+        'naïve café résumé',
+        # Decomposed: base letters followed by combining marks
+        'cafe\u0301 nai\u0308ve e\u0301te\u0301',
+        'Ω≈ç√ ∫˜µ ≤≥÷ — “quoted” ‘text’',
+        'emoji 😀 between 👍🏽 words',
+        'line one\r\nline two\rline three line four',
+        '--\nBob\n> quoted reply\n>> nested',
+        'a-b-c a.b.c a/b/c a@b.c',
+        'x' * 10000 + ' ' + 'y ' * 1000,
+    ]
+
+    def test_matches_reference_count(self):
+        for text in self.CASES:
+            with self.subTest(text=text[:40]):
+                self.assertEqual(email_parser.count_words(text), reference_count(text))
+
+    def test_regex_strategy_uses_count_words(self):
+        self.assertIs(email_parser.WORD_COUNTERS['regex'], email_parser.count_words)
+
+
+if __name__ == '__main__':
+    unittest.main()